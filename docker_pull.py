@@ -2,33 +2,94 @@
 
 import os
 import sys
-import gzip
 import json
 import hashlib
 import shutil
 import tarfile
-import urllib3
+import threading
+import time
 import pathlib
 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
+from typing import Optional
 from argparse import ArgumentParser
 from io import BytesIO
 
 import requests
 import click
 
-urllib3.disable_warnings()
-CHUNK_SIZE = 8192
+from requests.adapters import HTTPAdapter
+
+# ISA-L inflates 2-4x faster than zlib and is API compatible
+try:
+    from isal import igzip as gzip
+    from isal import isal_zlib as zlib
+except ImportError:
+    import gzip
+    import zlib
+
+# orjson is a faster drop-in, its dumps() returns bytes
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+CHUNK_SIZE = 1024 * 1024
+BUFFER_SIZE = 1024 * 1024
+# Docker itself pulls up to 5 layers concurrently
+MAX_WORKERS = 5
+PROGRESS_TRAITS = '=' * 49
+MANIFEST_V2 = 'application/vnd.docker.distribution.manifest.v2+json'
+MANIFEST_LIST_V2 = 'application/vnd.docker.distribution.manifest.list.v2+json'
+MANIFEST_TYPES = f'{MANIFEST_V2}, {MANIFEST_LIST_V2}'
+# Docker Hub auth endpoint is known, its pulls skip the anonymous request
+DOCKER_HUB = 'registry-1.docker.io'
+DOCKER_HUB_AUTH = 'https://auth.docker.io/token'
+DOCKER_HUB_SERVICE = 'registry.docker.io'
+
+# Shared session to keep connections alive across every registry call
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=16))
+
+# Bearer tokens by (auth_url, service, repository): (token, expiry time)
+TOKEN_CACHE = {}
+# Refresh tokens this many seconds before they expire
+TOKEN_MARGIN = 30
+
+# Set to stop the running layer downloads once one of them failed
+CANCEL_DOWNLOADS = threading.Event()
+# Keeps the status lines of concurrent downloads whole
+OUTPUT_LOCK = threading.Lock()
 
 
 @dataclass
 class URLData:
-    auth_url: str
+    auth_url: Optional[str]
     reg_service: str
     repository: str
     auth_type: str
 
 
+@dataclass
+class LayerData:
+    layerid: str
+    blob_file: str
+    size: int
+
+
+class LayerError(Exception):
+    """A layer could not be downloaded."""
+
+
+class DownloadCancelled(LayerError):
+    """A layer download stopped because another one failed."""
+
+
 @dataclass
 class ImageData:
     imgparts: str
@@ -54,18 +115,30 @@ class ImageData:
 def get_auth_head(url_data):
     """Get Docker token.
 
-    NOTE: this function is useless for unauthenticated registries like
-    Microsoft
+    The token is cached and only fetched again when it is about to expire.
+    Unauthenticated registries like Microsoft only get the Accept header.
     """
 
-    url = (
-        f'{url_data.auth_url}'
-        f'?service={url_data.reg_service}'
-        f'&scope=repository:{url_data.repository}:pull'
-    )
+    if url_data.auth_url is None:
+        return {'Accept': url_data.auth_type}
 
-    resp = requests.get(url, verify=False)
-    access_token = resp.json()['token']
+    key = (url_data.auth_url, url_data.reg_service, url_data.repository)
+    access_token, expiry = TOKEN_CACHE.get(key, (None, 0))
+
+    if time.time() > expiry - TOKEN_MARGIN:
+        url = (
+            f'{url_data.auth_url}'
+            f'?service={url_data.reg_service}'
+            f'&scope=repository:{url_data.repository}:pull'
+        )
+
+        resp = SESSION.get(url)
+        token = json_loads(resp.content)
+        access_token = token['token']
+
+        # The token spec defaults to 60 seconds when expires_in is missing
+        expiry = time.time() + token.get('expires_in', 60)
+        TOKEN_CACHE[key] = (access_token, expiry)
 
     auth_head = {
         'Authorization': f'Bearer {access_token}',
@@ -78,22 +151,17 @@ def get_auth_head(url_data):
 def progress_bar(ublob, nb_traits):
     """Docker style progress bar."""
 
-    # TODO: move to tqdm?
-
-    sys.stdout.write('\r' + ublob[7:19] + ': Downloading [')
-
-    for i in range(0, nb_traits):
+    bar = PROGRESS_TRAITS[:nb_traits - 1] + '>' if nb_traits else ''
+    sys.stdout.write(f'\r{ublob[7:19]}: Downloading [{bar.ljust(49)}]')
+    sys.stdout.flush()
 
-        if i == nb_traits - 1:
-            sys.stdout.write('>')
-        else:
-            sys.stdout.write('=')
 
-    for i in range(0, 49 - nb_traits):
-        sys.stdout.write(' ')
+def print_status(ublob, status):
+    """Print a layer status line, safe to call from the download threads."""
 
-    sys.stdout.write(']')
-    sys.stdout.flush()
+    with OUTPUT_LOCK:
+        sys.stdout.write(f'\r{ublob[7:19]}: {status}\n')
+        sys.stdout.flush()
 
 
 def build_options():
@@ -129,7 +197,7 @@ def parse_image(image):
         repo = '/'.join(imgparts[1:-1])
 
     else:
-        registry = 'registry-1.docker.io'
+        registry = DOCKER_HUB
         if len(imgparts[:-1]) != 0:
             repo = '/'.join(imgparts[:-1])
         else:
@@ -140,40 +208,61 @@ def parse_image(image):
     return ImageData(imgparts, registry, repo, img, tag, repository)
 
 
-def manifest_error(resp, url_data, image_data):
+def manifest_error(resp, url_data):
 
     print(
         f'[-] Cannot fetch manifest for {url_data.repository} '
         f'[HTTP {resp.status_code}]'
     )
     print(resp.content)
+    sys.exit(1)
 
-    auth_type = 'application/vnd.docker.distribution.manifest.list.v2+json'
-    url_data.auth_type = auth_type
-    auth_head = get_auth_head(url_data)
 
-    url = f'https://{registry}/v2/{image_data.repository}/manifests/{tag}'
-    resp = requests.get(url, headers=auth_head, verify=False)
+def manifest_list(resp, image_data, auth_head):
+    """Fetch the linux/amd64 manifest from the manifest list of the tag.
 
-    if (resp.status_code == 200):
-        print(
-            '[+] Manifests found for this tag (use the @digest format to '
-            'pull the corresponding image):'
-        )
+    Docker Hub serves this manifest to clients which only accept v2
+    manifests, the list is only asked for once the v2 manifest was refused.
+    Without such a platform, the manifests are listed instead. When the tag
+    has no list either, the first error response is returned.
+    """
 
-        manifests = resp.json()['manifests']
-        for manifest in manifests:
-            for key, value in manifest["platform"].items():
-                sys.stdout.write(f'{key}: {value}, ')
+    headers = {**auth_head, 'Accept': MANIFEST_TYPES}
+    list_resp = SESSION.get(image_data.manifest_url, headers=headers)
 
-            print(f'digest: {manifest["digest"]}')
+    content_type = list_resp.headers.get('Content-Type', '')
+    if list_resp.status_code != 200 or \
+            not content_type.startswith(MANIFEST_LIST_V2):
+        return resp
 
-    sys.exit(1)
+    manifests = json_loads(list_resp.content)['manifests']
+    for manifest in manifests:
+        platform = manifest['platform']
+        if platform['os'] == 'linux' and platform['architecture'] == 'amd64':
+            url = (
+                f'{image_data.base_url}/{image_data.repository}'
+                f'/manifests/{manifest["digest"]}'
+            )
+            return SESSION.get(url, headers=auth_head)
+
+    print(
+        '[+] Manifests found for this tag (use the @digest format to '
+        'pull the corresponding image):'
+    )
+
+    for manifest in manifests:
+        for key, value in manifest["platform"].items():
+            sys.stdout.write(f'{key}: {value}, ')
+
+        print(f'digest: {manifest["digest"]}')
 
+    sys.exit(1)
 
-def get_base_json():
 
-    container_config = {
+# json of every layer but the last one
+EMPTY_LAYER_JSON = {
+    "created": "1970-01-01T00:00:00Z",
+    "container_config": {
         "Hostname": "",
         "Domainname": "",
         "User": "",
@@ -191,25 +280,22 @@ def get_base_json():
         "Entrypoint": None,
         "OnBuild": None,
         "Labels": None,
-    }
-
-    empty_dict = {
-        "created": "1970-01-01T00:00:00Z",
-        "container_config":  container_config,
-    }
+    },
+}
 
-    return json.dumps(empty_dict)
 
+def get_url_data(image_data, resp=None):
 
-def get_url_data(image_data):
+    # Get Docker authentication endpoint from an anonymous request, when it
+    # is required
+    auth_url = None
+    reg_service = ''
 
-    # Get Docker authentication endpoint when it is required
-    auth_url='https://auth.docker.io/token'
-    reg_service='registry.docker.io'
+    if resp is None:  # Docker Hub
+        auth_url = DOCKER_HUB_AUTH
+        reg_service = DOCKER_HUB_SERVICE
 
-    resp = requests.get(image_data.base_url, verify=False)
-
-    if resp.status_code == 401:
+    elif resp.status_code == 401:
         auth_url = resp.headers['WWW-Authenticate'].split('"')[1]
         try:
             reg_service = resp.headers['WWW-Authenticate'].split('"')[3]
@@ -217,7 +303,7 @@ def get_url_data(image_data):
             reg_service = ""
 
     # Fetch manifest v2 and get image layer digests
-    auth_type = 'application/vnd.docker.distribution.manifest.v2+json'
+    auth_type = MANIFEST_V2
 
     url_data = URLData(
         auth_url=auth_url,
@@ -229,56 +315,245 @@ def get_url_data(image_data):
     return url_data
 
 
-def save_chunks(layerdir, bresp, ublob, nb_traits):
+def preallocate(file, length):
+    """Reserve length bytes on disk for file, when the platform can."""
+
+    if not hasattr(os, 'posix_fallocate'):
+        return
+
+    try:
+        os.posix_fallocate(file.fileno(), 0, length)
+    except OSError:  # Filesystem without fallocate support
+        pass
+
+
+@contextmanager
+def open_layer(blob_file):
+    """Open a layer blob, reading its uncompressed tar.
+
+    gzip reads the compressed blob in small blocks, the large file buffer
+    turns them into few read calls.
+    """
+
+    with open(blob_file, 'rb', buffering=BUFFER_SIZE) as file, \
+            gzip.GzipFile(fileobj=file, mode='rb') as unzLayer:
+        yield unzLayer
+
+
+class LayerSizeCounter:
+    """Count the uncompressed size of a gzipped blob fed chunk by chunk.
+
+    Reads like GzipFile: a blob may hold several gzip members, zero padding
+    may follow each of them. The output is dropped as soon as counted.
+    """
+
+    def __init__(self):
+        self.size = 0
+        self._decomp = None
+        self._first_member = True
+
+    def update(self, data):
+
+        while True:
+            if self._decomp is None:  # Between two members
+                if not self._first_member:
+                    data = data.lstrip(b'\x00')
+                if not data:
+                    return
+                self._first_member = False
+                self._decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
 
-    unit = int(bresp.headers['Content-Length']) / 50
-    acc = 0
+            # Bounded output, a chunk may inflate to many times its size
+            out = self._decomp.decompress(data, BUFFER_SIZE)
+            self.size += len(out)
 
-    layer_file = layerdir / 'layer_gzip.tar'
-    with open(layer_file, "wb") as file:
+            if self._decomp.eof:
+                data = self._decomp.unused_data
+                self._decomp = None
+            else:
+                data = self._decomp.unconsumed_tail
+                if not data and len(out) < BUFFER_SIZE:
+                    return
+
+    def close(self):
+        """Return the size, the blob must not end inside a member."""
+
+        if self._decomp is not None:
+            raise EOFError('Compressed file ended before the end-of-stream '
+                           'marker was reached')
+        return self.size
+
+
+def save_layer(blob_file, bresp, ublob, show_progress):
+    """Save the gzipped layer blob, return the size of its uncompressed tar.
+
+    The blob digest is checked and the tar header size counted while it is
+    downloaded, so the blob is only inflated again to fill the archive.
+    """
+
+    length = int(bresp.headers['Content-Length'])
+    step = max(1, length // 50)
+    next_mark = step
+    written = 0
+
+    algorithm, digest = ublob.split(':', 1)
+    blob_hash = hashlib.new(algorithm)
+    counter = LayerSizeCounter()
+    inflate_error = None
+
+    with open(blob_file, "wb", buffering=BUFFER_SIZE) as file:
+
+        # A single allocation upfront keeps the blob in few extents
+        preallocate(file, length)
 
         for chunk in bresp.iter_content(chunk_size=CHUNK_SIZE):
 
+            if CANCEL_DOWNLOADS.is_set():
+                raise DownloadCancelled(ublob)
+
             if not chunk:
                 continue
 
             file.write(chunk)
-            acc = acc + CHUNK_SIZE
-            if acc > unit:
-                nb_traits = nb_traits + 1
+            blob_hash.update(chunk)
+
+            # A corrupted blob is reported by the digest check first
+            if inflate_error is None:
+                try:
+                    counter.update(chunk)
+                except (OSError, zlib.error) as err:
+                    inflate_error = err
+
+            # A chunk may cover several traits, the bar holds 49 at most
+            written = written + len(chunk)
+            if show_progress and written >= next_mark:
+                nb_traits = min(written // step, len(PROGRESS_TRAITS))
+                next_mark = (written // step + 1) * step
                 progress_bar(ublob, nb_traits)
-                acc = 0
 
+    if blob_hash.hexdigest() != digest:
+        raise LayerError(f'Digest mismatch for layer {ublob[7:19]}')
+
+    try:
+        if inflate_error is not None:
+            raise inflate_error
+        return counter.close()
+    except (OSError, EOFError, zlib.error):
+        raise LayerError(f'Cannot decompress layer {ublob[7:19]}')
 
-def layer_error(layer, auth_head):
 
-    bresp = requests.get(
-        layer['urls'][0],
-        headers=auth_head,
-        stream=True,
-        verify=False
-    )
+def layer_error(layer, auth_head, bresp):
 
-    if bresp.status_code == 200:
-        return bresp
+    ublob = layer['digest']
+
+    # Only foreign layers are located at a custom URL
+    if layer.get('urls'):
+        bresp = SESSION.get(
+            layer['urls'][0],
+            headers=auth_head,
+            stream=True,
+        )
+
+        if bresp.status_code == 200:
+            return bresp
 
     err_msg = (
-        f'\rERROR: Cannot download layer {ublob[7:19]} '
-        f'[HTTP {bresp.status_code}]'
+        f'Cannot download layer {ublob[7:19]} '
+        f'[HTTP {bresp.status_code}]\n{bresp.content}'
     )
-    print(err_msg)
-    print(bresp.content)
-    sys.exit(1)
+    raise LayerError(err_msg)
 
 
-def get_fake_layerid():
+def get_fake_layerid(parentid, ublob):
 
     # FIXME: Creating fake layer ID. Don't know how Docker generates it
-    fake_layerid = "{parentid}\n"
-    fake_layerid += "{ublob}\n"
-    fake_layerid = fake_layerid.encode('utf-8')
-    fake_layerid = hashlib.sha256(fake_layerid)
-    fake_layerid = fake_layerid.hexdigest()
+    fake_layerid = hashlib.sha256()
+    fake_layerid.update(parentid.encode('ascii'))
+    fake_layerid.update(b'\n')
+    fake_layerid.update(ublob.encode('ascii'))
+    fake_layerid.update(b'\n')
+    return fake_layerid.hexdigest()
+
+
+def download_layer(layer, url_data, image_data, imgdir, show_progress):
+    """Download a layer blob, return its path and uncompressed size.
+
+    Any failure stops the other downloads right away, before the main thread
+    gets to this layer. Concurrent downloads would all draw their progress
+    bar on the same line, so they only print status lines.
+    """
+
+    if CANCEL_DOWNLOADS.is_set():
+        raise DownloadCancelled(layer['digest'])
+
+    try:
+        return get_layer_blob(
+            layer, url_data, image_data, imgdir, show_progress
+        )
+    except BaseException:
+        CANCEL_DOWNLOADS.set()
+        raise
+
+
+def get_layer_blob(layer, url_data, image_data, imgdir, show_progress):
+
+    ublob = layer['digest']
+    auth_head = get_auth_head(url_data)
+
+    if show_progress:
+        sys.stdout.write(ublob[7:19] + ': Downloading...')
+        sys.stdout.flush()
+    else:
+        print_status(ublob, 'Downloading')
+
+    url = f"{image_data.blobs_url}/{ublob}"
+    bresp = SESSION.get(url, headers=auth_head, stream=True)
+
+    # When the layer is located at a custom URL
+    if bresp.status_code != 200:
+        bresp = layer_error(layer, auth_head, bresp)
+
+    # Stream download and follow the progress
+    if show_progress:
+        progress_bar(ublob, 0)
+
+    blob_file = os.path.join(imgdir, f'{ublob[7:]}.tar.gz')
+    size = save_layer(blob_file, bresp, ublob, show_progress)
+
+    if not show_progress:
+        print_status(ublob, 'Download complete')
+
+    return blob_file, size
+
+
+def finalize_layer(layer, parentid, imgdir, json_obj):
+    """Build the folder of a downloaded layer, return its fake ID.
+
+    layer.tar itself is only written when the image archive is created.
+    """
+
+    ublob = layer['digest']
+    fake_layerid = get_fake_layerid(parentid, ublob)
+
+    layerdir = os.path.join(imgdir, fake_layerid)
+    os.mkdir(layerdir)
+
+    # Creating VERSION file
+    layer_version = os.path.join(layerdir, 'VERSION')
+    with open(layer_version, 'w') as file:
+        file.write('1.0')
+
+    print_status(ublob, f"Pull complete [{layer['size']}]{' '*50}")
+
+    json_obj['id'] = fake_layerid
+    if parentid:
+        json_obj['parent'] = parentid
+
+    # Creating json file
+    json_file = os.path.join(layerdir, 'json')
+    with open(json_file, 'wb') as file:
+        file.write(json_dumps(json_obj))
+
     return fake_layerid
 
 
@@ -286,107 +561,136 @@ def func_layers(layers, url_data, image_data, imgdir, content, confresp):
 
     # TODO: better function name...
 
-    # Build layer folders
+    # last layer = config manifest - history - rootfs
+    # FIXME: json loads automatically converts to unicode, thus decoding
+    # values whereas Docker doesn't
+    last_layer_json = json_loads(confresp.content)
+    del last_layer_json['history']
+    try:
+        del last_layer_json['rootfs']
+    except:  # Because Microsoft loves case insensitiveness
+        del last_layer_json['rootfS']
+
+    # Manifests may list the same blob several times, e.g. empty layers, it
+    # is only downloaded once
+    unique_layers = {layer['digest']: layer for layer in layers}
+
+    # Progress bars only make sense for a single download at a time
+    show_progress = min(MAX_WORKERS, len(unique_layers)) == 1
+
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    downloads = {
+        ublob: executor.submit(
+            download_layer, layer, url_data, image_data, imgdir, show_progress
+        )
+        for ublob, layer in unique_layers.items()
+    }
+    futures = [downloads[layer['digest']] for layer in layers]
+
+    # Build layer folders in manifest order to chain the parent IDs
+    layer_files = []
     parentid = ''
-    for layer in layers:
+    try:
+        for layer, future in zip(layers, futures):
 
-        ublob = layer['digest']
-        fake_layerid = get_fake_layerid()
+            if layer is layers[-1]:
+                json_obj = last_layer_json
+            else:  # other layers json are empty
+                # Only top-level keys get set, a shallow copy is enough
+                json_obj = dict(EMPTY_LAYER_JSON)
 
-        base_path = pathlib.Path(__file__).absolute().parent
-        layerdir = base_path / imgdir / fake_layerid
-        layerdir.mkdir()
+            blob_file, size = future.result()
+            fake_layerid = finalize_layer(layer, parentid, imgdir, json_obj)
+            content[0]['Layers'].append(fake_layerid + '/layer.tar')
+            layer_files.append(LayerData(fake_layerid, blob_file, size))
+            parentid = fake_layerid
 
-        # Creating VERSION file
-        layer_version = layerdir / 'VERSION'
-        with open(layer_version, 'w') as file:
-            file.write('1.0')
+    except LayerError:
+        cancel_downloads(executor)
 
-        # Creating layer.tar file
-        sys.stdout.write(ublob[7:19] + ': Downloading...')
-        sys.stdout.flush()
+        # This layer may only have been cancelled by another one's failure
+        err = download_failure(futures)
+        if not isinstance(err, LayerError):
+            raise err
 
-        # refreshing token to avoid its expiration
-        auth_type = 'application/vnd.docker.distribution.manifest.v2+json'
-        auth_head = get_auth_head(url_data)
+        print(f'\rERROR: {err}')
+        sys.exit(1)
 
-        url = f"{image_data.blobs_url}/{ublob}"
-        bresp = requests.get(url, headers=auth_head, stream=True, verify=False)
+    except BaseException:  # Ctrl-C or unexpected errors
+        cancel_downloads(executor)
+        raise
 
-        # When the layer is located at a custom URL
-        if bresp.status_code != 200:
-            bresp = layer_error(layer, auth_head)
+    executor.shutdown()
 
-        # Stream download and follow the progress
-        bresp.raise_for_status()
-        nb_traits = 0
-        progress_bar(ublob, nb_traits)
+    return layer_files
 
-        save_chunks(layerdir, bresp, ublob, nb_traits)
 
-        # Ugly but works everywhere
-        msg = f"\r{ublob[7:19]}: Extracting...{' '*50}"
-        sys.stdout.write(msg)
-        sys.stdout.flush()
+def cancel_downloads(executor):
+    """Drop the queued layer downloads and stop the running ones."""
 
-        # Decompress gzip response
-        layer_tar_file = layerdir / 'layer.tar'
-        layer_gzip_file = layerdir / 'layer_gzip.tar'
+    CANCEL_DOWNLOADS.set()
+    executor.shutdown(wait=False, cancel_futures=True)
 
-        with open(layer_tar_file, "wb") as file:
-            unzLayer = gzip.open(layer_gzip_file, 'rb')
-            shutil.copyfileobj(unzLayer, file)
-            unzLayer.close()
 
-        layer_gzip_file.unlink()
-        msg = (
-            f"\r{ublob[7:19],}: Pull complete "
-            f"[{bresp.headers['Content-Length']}]"
-        )
-        print(msg)
+def download_failure(futures):
+    """Return the error which made the layer downloads stop."""
 
-        content[0]['Layers'].append(fake_layerid + '/layer.tar')
+    for future in futures:
+        if future.cancelled():
+            continue
 
-        # last layer = config manifest - history - rootfs
-        if layers[-1]['digest'] == layer['digest']:
+        err = future.exception()
+        if err is not None and not isinstance(err, DownloadCancelled):
+            return err
 
-            # FIXME: json.loads() automatically converts to unicode, thus
-            # decoding values whereas Docker doesn't
 
-            json_obj = json.loads(confresp.content)
-            del json_obj['history']
-            try:
-                del json_obj['rootfs']
-            except:  # Because Microsoft loves case insensitiveness
-                del json_obj['rootfS']
+def scan_image_dir(path, arcname=''):
+    """Yield (path, arcname) of the image files, sorted, without layer blobs."""
 
-        else:  # other layers json are empty
-            json_obj = json.loads(empty_json)
+    for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
 
-        json_obj['id'] = fake_layerid
-        if parentid:
-            json_obj['parent'] = parentid
+        if entry.name.endswith('.tar.gz'):
+            continue
 
-        parentid = json_obj['id']
+        name = arcname + entry.name
+        yield entry.path, name
 
-        # Creating json file
-        json_file = layerdir / 'json'
-        with open(json_file, 'w') as file:
-            json.dump(json_obj, file)
+        if entry.is_dir(follow_symlinks=False):
+            yield from scan_image_dir(entry.path, name + '/')
 
-    return fake_layerid
 
-def save_image_tar(repo, img, imgdir):
+def save_image_tar(repo, img, imgdir, layer_files):
 
     # Create image tar and clean tmp folder
     docker_tar = repo.replace('/', '_') + '_' + img + '.tar'
     sys.stdout.write("Creating archive...")
     sys.stdout.flush()
 
-    tar = tarfile.open(docker_tar, "w")
-    tar.add(imgdir, arcname=os.path.sep)
+    # Stream mode with large blocks, nothing in the archive needs a seek.
+    # copybufsize sizes the copies done by add() and addfile()
+    tar = tarfile.open(
+        docker_tar,
+        "w|",
+        bufsize=BUFFER_SIZE,
+        copybufsize=BUFFER_SIZE
+    )
+    for path, arcname in scan_image_dir(imgdir):
+        tar.add(path, arcname=arcname, recursive=False)
+
+    # Decompress each blob straight into its layer.tar entry, its size was
+    # counted while downloading
+    for layer in layer_files:
+        tarinfo = tarfile.TarInfo(f'{layer.layerid}/layer.tar')
+        tarinfo.size = layer.size
+        tarinfo.mtime = os.path.getmtime(layer.blob_file)
+
+        with open_layer(layer.blob_file) as unzLayer:
+            tar.addfile(tarinfo, unzLayer)
+
     tar.close()
 
+    return docker_tar
+
 
 def get_content_json(image_data, fake_layerid):
 
@@ -424,19 +728,26 @@ def main(image):
     """
 
     image_data = parse_image(image)
-    url_data = get_url_data(image_data)
-    auth_head = get_auth_head(url_data)
 
-    resp = requests.get(
-        image_data.manifest_url,
-        headers=auth_head,
-        verify=False
-    )
+    # Other registries only get a token fetched when they ask for one
+    resp = None
+    if image_data.registry != DOCKER_HUB:
+        auth_head = {'Accept': MANIFEST_V2}
+        resp = SESSION.get(image_data.manifest_url, headers=auth_head)
+    url_data = get_url_data(image_data, resp)
+
+    if url_data.auth_url is not None:
+        auth_head = get_auth_head(url_data)
+        resp = SESSION.get(image_data.manifest_url, headers=auth_head)
+
+    if resp.status_code != 200:
+        resp = manifest_list(resp, image_data, auth_head)
 
     if resp.status_code != 200:
-        manifest_error(resp, url_data, image_data)
+        manifest_error(resp, url_data)
 
-    layers = resp.json()['layers']
+    manifest = json_loads(resp.content)
+    layers = manifest['layers']
 
     # Create tmp folder that will hold the image
     img_tag = image_data.tag.replace(':', '@')
@@ -445,12 +756,11 @@ def main(image):
     imgdir.mkdir()
     print(f'Creating image structure in: {imgdir}')
 
-    config = resp.json()
-    config = config['config']['digest']
+    config = manifest['config']['digest']
     config_base = config[7:]
 
     url = f'{image_data.blobs_url}/{config}'
-    confresp = requests.get(url, headers=auth_head, verify=False)
+    confresp = SESSION.get(url, headers=auth_head)
 
     filename = f'{imgdir}/{config_base}.json'
     with open(filename, 'wb') as file:
@@ -464,37 +774,44 @@ def main(image):
     content = [content]
 
     if len(image_data.imgparts[:-1]) != 0:
-        path = '/'.join(imgparts[:-1]) + '/' + img + ':' + tag
+        path = (
+            '/'.join(image_data.imgparts[:-1]) + '/' + image_data.img + ':'
+            + image_data.tag
+        )
     else:
         path = image_data.img + ':' + image_data.tag
 
     content[0]['RepoTags'].append(path)
-    empty_json = get_base_json()
-    fake_layerid = func_layers(
+    layer_files = func_layers(
         layers,
         url_data,
         image_data,
         imgdir,
         content,
-        confresp
+        confresp,
     )
 
     manifest_file = imgdir / 'manifest.json'
-    with open(manifest_file, 'w') as file:
-        file.write(json.dumps(content))
+    with open(manifest_file, 'wb') as file:
+        file.write(json_dumps(content))
 
-    content = get_content_json(image_data, fake_layerid)
+    content = get_content_json(image_data, layer_files[-1].layerid)
 
     repositories_file = imgdir / 'repositories'
-    with open(repositories_file, 'w') as file:
-        json.dump(content, file)
+    with open(repositories_file, 'wb') as file:
+        file.write(json_dumps(content))
 
-    save_image_tar(image_data.repo, image_data.img, imgdir)
+    docker_tar = save_image_tar(
+        image_data.repo,
+        image_data.img,
+        imgdir,
+        layer_files
+    )
 
     # clean up
     shutil.rmtree(imgdir)
 
-    print('\rDocker image pulled: {docker_tar}')
+    print(f'\rDocker image pulled: {docker_tar}')
 
 
 if __name__ == "__main__":